@@ -0,0 +1,345 @@
+"""End-to-end media benchmark.
+
+Runs the video and audio send/receive pipelines on loopback through an
+ImpairmentProxy and reports glass-to-glass video latency, mouth-to-ear audio
+latency, frame delivery rate, audio glitches and CPU per stream.
+
+    python benchmark.py --profile all --duration 10 --output bench_results.json
+    python benchmark.py --compare old.json new.json
+"""
+import argparse
+import json
+import socket
+import subprocess
+import threading
+import time
+import numpy as np
+from media import BUFFER_SIZE, send_video_frame, VideoReceiver, pack_audio, AudioReceiver
+from netem_proxy import MAX_QUEUE_DELAY, ImpairmentProxy
+
+# Configuration
+VIDEO_WIDTH = 640
+VIDEO_HEIGHT = 480
+VIDEO_FPS = 30
+CHUNK = 1024
+RATE = 44100
+TONE_HZ = 440
+BARCODE_BITS = 24  # Frame index is drawn into the frame as a row of black/white blocks
+BARCODE_BLOCK = VIDEO_WIDTH // BARCODE_BITS
+BARCODE_HEIGHT = 24
+PATTERN_FRAMES = 30  # Test pattern frames rendered up front, so the sender's CPU is spent on encoding
+
+# Impairment profiles, passed straight to ImpairmentProxy
+PROFILES = {
+    "clean": {},
+    "lan": {"delay": 0.002, "jitter": 0.001},
+    "wifi": {"delay": 0.015, "jitter": 0.010, "loss": 0.01, "reorder": 0.01},
+    "lossy": {"delay": 0.040, "jitter": 0.015, "loss": 0.02, "burst_start": 0.005, "burst_end": 0.3},
+    "congested": {"delay": 0.030, "jitter": 0.005, "bandwidth": 2_000_000},
+}
+
+
+def draw_barcode(frame, index):
+    """Draw a frame index into the top rows of a frame."""
+    for bit in range(BARCODE_BITS):
+        value = 255 if (index >> bit) & 1 else 0
+        frame[:BARCODE_HEIGHT, bit * BARCODE_BLOCK:(bit + 1) * BARCODE_BLOCK] = value
+
+
+def read_barcode(frame):
+    """Read back a frame index drawn by draw_barcode, surviving JPEG artifacts."""
+    strip = frame[4:BARCODE_HEIGHT - 4, :BARCODE_BITS * BARCODE_BLOCK].mean(axis=(0, 2))
+    bits = strip.reshape(BARCODE_BITS, BARCODE_BLOCK)[:, 4:-4].mean(axis=1) > 127
+    return int(np.dot(bits, 1 << np.arange(BARCODE_BITS)))
+
+
+def synthetic_frame(index):
+    """Return a moving test pattern stamped with its frame index."""
+    x = np.arange(VIDEO_WIDTH)
+    y = np.arange(VIDEO_HEIGHT)[:, None]
+    frame = np.empty((VIDEO_HEIGHT, VIDEO_WIDTH, 3), dtype=np.uint8)
+    frame[:, :, 0] = (x + index * 4) % 256
+    frame[:, :, 1] = (y + index * 2) % 256
+    frame[:, :, 2] = ((x + y) // 2 + index) % 256
+    draw_barcode(frame, index)
+    return frame
+
+
+def tone_chunk(sequence_number):
+    """Return one chunk of a continuous sine tone as 16-bit PCM."""
+    t = (np.arange(CHUNK) + sequence_number * CHUNK) / RATE
+    return (np.sin(2 * np.pi * TONE_HZ * t) * 8000).astype(np.int16).tobytes()
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "max": None}
+    values = np.asarray(values) * 1000  # Report milliseconds
+    return {"p50": round(float(np.percentile(values, 50)), 2),
+            "p95": round(float(np.percentile(values, 95)), 2),
+            "max": round(float(values.max()), 2)}
+
+
+class Stream:
+    """Shared state for one benchmarked media stream."""
+
+    def __init__(self):
+        self.sending = True
+        self.receiving = True  # Cleared later than sending so in-flight packets are still counted
+        self.sent_at = {}
+        self.latencies = []
+        self.decode_errors = 0
+        self.glitches = 0
+        self.lost = 0
+        self.cpu = 0.0
+        self.lock = threading.Lock()
+
+    def add_cpu(self, start):
+        with self.lock:
+            self.cpu += time.thread_time() - start
+
+
+def open_receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.2)
+    return sock
+
+
+def video_sender(stream, sock, addr):
+    """Capture synthetic frames at VIDEO_FPS and send them like P2PChat.send_video."""
+    patterns = [synthetic_frame(index) for index in range(PATTERN_FRAMES)]
+    cpu_start = time.thread_time()
+    index = 0
+    next_frame = time.perf_counter()
+    while stream.sending:
+        frame = patterns[index % PATTERN_FRAMES]
+        draw_barcode(frame, index)  # Overwrites the whole strip, so reusing the frame is safe
+        stream.sent_at[index] = time.perf_counter()  # "Glass" time: frame captured
+        send_video_frame(sock, frame, addr, index)
+        index += 1
+
+        next_frame += 1 / VIDEO_FPS
+        time.sleep(max(0.0, next_frame - time.perf_counter()))
+    stream.add_cpu(cpu_start)
+
+
+def video_receiver(stream, sock):
+    """Receive and decode frames like P2PChat.receive_video, timing each one."""
+    cpu_start = time.thread_time()
+    receiver = VideoReceiver(sock)
+    seen = set()
+    while stream.receiving:
+        try:
+            frame = receiver.read_frame()
+        except socket.timeout:
+            continue
+        except Exception:
+            stream.decode_errors += 1
+            continue
+        if frame is None:
+            stream.decode_errors += 1
+            continue
+
+        index = read_barcode(frame)
+        sent_at = stream.sent_at.get(index)
+        if sent_at is not None and index not in seen:
+            seen.add(index)
+            stream.latencies.append(time.perf_counter() - sent_at)  # "Glass" time: frame decoded
+    stream.add_cpu(cpu_start)
+
+
+def audio_sender(stream, sock, addr):
+    """Send tone chunks at the real-time rate like P2PChat.send_audio."""
+    cpu_start = time.thread_time()
+    sequence_number = 0
+    next_chunk = time.perf_counter() + CHUNK / RATE
+    while stream.sending:
+        # Wait until the "microphone" has captured a whole chunk
+        time.sleep(max(0.0, next_chunk - time.perf_counter()))
+        stream.sent_at[sequence_number] = time.perf_counter() - CHUNK / RATE  # "Mouth" time: first sample
+        sock.sendto(pack_audio(sequence_number, tone_chunk(sequence_number)), addr)
+        sequence_number += 1
+        next_chunk += CHUNK / RATE
+    stream.add_cpu(cpu_start)
+
+
+def audio_receiver(stream, sock, denoise):
+    """Receive audio like P2PChat.receive_audio and play it into a simulated output device.
+
+    The device keeps one chunk of playout buffer, set up when the first chunk
+    arrives and again after every underrun, and drains CHUNK / RATE seconds
+    per chunk; if it runs dry before the next chunk is written that is counted
+    as a glitch (audible gap).
+    """
+    cpu_start = time.thread_time()
+    receiver = AudioReceiver(log_loss=False)
+    device_free_at = None
+    while stream.receiving:
+        try:
+            packet, _ = sock.recvfrom(CHUNK * 2 + 4)
+        except socket.timeout:
+            continue
+
+        playable = receiver.push(packet)
+        if playable is None:
+            continue
+        sequence_number, data = playable
+        if denoise is not None:
+            audio_array = np.frombuffer(data, dtype=np.int16)
+            denoise(y=audio_array, sr=RATE).astype(np.int16).tobytes()
+
+        now = time.perf_counter()
+        if device_free_at is None:
+            device_free_at = now + CHUNK / RATE  # Playout buffer prefilled with one chunk
+        elif now > device_free_at:
+            stream.glitches += 1  # Output buffer underran
+            device_free_at = now + CHUNK / RATE
+        play_at = device_free_at  # "Ear" time: when this chunk starts playing
+        device_free_at += CHUNK / RATE
+
+        sent_at = stream.sent_at.get(sequence_number)
+        if sent_at is not None:
+            stream.latencies.append(play_at - sent_at)
+    stream.lost = receiver.lost
+    stream.add_cpu(cpu_start)
+
+
+def run_profile(name, impairment, duration, seed, denoise):
+    """Run both pipelines through one impairment profile and return the measurements."""
+    video, audio = Stream(), Stream()
+    video_recv, audio_recv = open_receiver(), open_receiver()
+    video_send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    video_send.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUFFER_SIZE * 16)
+    audio_send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    video_proxy = ImpairmentProxy(("127.0.0.1", 0), video_recv.getsockname(), seed=seed, **impairment).start()
+    audio_proxy = ImpairmentProxy(("127.0.0.1", 0), audio_recv.getsockname(), seed=seed, **impairment).start()
+
+    threads = [
+        threading.Thread(target=video_receiver, args=(video, video_recv)),
+        threading.Thread(target=audio_receiver, args=(audio, audio_recv, denoise)),
+        threading.Thread(target=video_sender, args=(video, video_send, video_proxy.listen_addr)),
+        threading.Thread(target=audio_sender, args=(audio, audio_send, audio_proxy.listen_addr)),
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+
+    # Stop senders first and give in-flight packets time to arrive
+    video.sending = audio.sending = False
+    for thread in threads[2:]:
+        thread.join()
+    drain = video_proxy.delay + video_proxy.jitter + video_proxy.reorder_delay + MAX_QUEUE_DELAY
+    time.sleep(drain)
+    video.receiving = audio.receiving = False
+    for thread in threads[:2]:
+        thread.join()
+    video_proxy.stop()
+    audio_proxy.stop()
+    for sock in (video_recv, audio_recv, video_send, audio_send):
+        sock.close()
+
+    frames_sent = len(video.sent_at)
+    chunks_sent = len(audio.sent_at)
+    return {
+        "profile": name,
+        "impairment": impairment,
+        "video": {
+            "frames_sent": frames_sent,
+            "frames_delivered": len(video.latencies),
+            "delivery_rate": round(len(video.latencies) / frames_sent, 4) if frames_sent else None,
+            "decode_errors": video.decode_errors,
+            "glass_to_glass_ms": percentiles(video.latencies),
+            "cpu_percent": round(100 * video.cpu / duration, 2),
+            "proxy": video_proxy.stats,
+        },
+        "audio": {
+            "chunks_sent": chunks_sent,
+            "chunks_played": len(audio.latencies),
+            "chunks_lost": audio.lost,
+            "glitches": audio.glitches,
+            "mouth_to_ear_ms": percentiles(audio.latencies),
+            "cpu_percent": round(100 * audio.cpu / duration, 2),
+            "proxy": audio_proxy.stats,
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(old_path, new_path):
+    """Print the change in headline metrics between two result files."""
+    with open(old_path) as f:
+        old = {r["profile"]: r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {r["profile"]: r for r in json.load(f)["results"]}
+
+    metrics = [
+        ("video", "glass_to_glass_ms", "p95"),
+        ("video", "delivery_rate", None),
+        ("video", "cpu_percent", None),
+        ("audio", "mouth_to_ear_ms", "p95"),
+        ("audio", "glitches", None),
+        ("audio", "cpu_percent", None),
+    ]
+    for profile in sorted(old.keys() & new.keys()):
+        print(f"[{profile}]")
+        for media, metric, key in metrics:
+            before = old[profile][media][metric]
+            after = new[profile][media][metric]
+            if key:
+                before, after = before[key], after[key]
+            label = f"{media}.{metric}" + (f".{key}" if key else "")
+            if before is None or after is None:
+                print(f"  {label:32} {before} -> {after}")
+            else:
+                print(f"  {label:32} {before} -> {after} ({after - before:+.2f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end media benchmark over an impaired loopback link.")
+    parser.add_argument("--profile", default="all", choices=[*PROFILES, "all"])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per profile")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the impairment")
+    parser.add_argument("--denoise", action="store_true", help="include noisereduce in the audio receiver")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    denoise = None
+    if args.denoise:
+        import noisereduce as nr
+        denoise = nr.reduce_noise
+
+    names = list(PROFILES) if args.profile == "all" else [args.profile]
+    results = []
+    for name in names:
+        print(f"Running profile '{name}' for {args.duration:.0f}s...")
+        result = run_profile(name, PROFILES[name], args.duration, args.seed, denoise)
+        print(f"  video: {result['video']['delivery_rate']} delivered, "
+              f"p95 {result['video']['glass_to_glass_ms']['p95']} ms, "
+              f"cpu {result['video']['cpu_percent']}%")
+        print(f"  audio: {result['audio']['glitches']} glitches, "
+              f"p95 {result['audio']['mouth_to_ear_ms']['p95']} ms, "
+              f"cpu {result['audio']['cpu_percent']}%")
+        results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump({"revision": git_revision(), "timestamp": time.time(),
+                   "duration": args.duration, "seed": args.seed, "results": results}, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import queue
+import socket
+import struct
+import time
+import numpy as np
+import cv2
+
+# Configuration
+BUFFER_SIZE = 4096 * 10
+VIDEO_QUALITY = 50  # JPEG quality for webcam frames
+VIDEO_RESYNC_GAP = 256  # A frame id this far behind means the sender restarted, not a late chunk
+MAX_AUDIO_PACKET = 4096  # Largest audio packet we accept (1024 16-bit samples plus header fit easily)
+
+# Wire headers: every video chunk carries (frame id, chunk index, chunk count), audio chunks a sequence number
+VIDEO_CHUNK_HEADER = struct.Struct("!IHH")
+AUDIO_SEQ_HEADER = struct.Struct("!I")
+VIDEO_CHUNK_SIZE = BUFFER_SIZE - VIDEO_CHUNK_HEADER.size
+
+
+def send_video_frame(sock, frame, addr, frame_id, quality=VIDEO_QUALITY):
+    """Encode a frame as JPEG and send it in chunks tagged with the frame id."""
+    _, frame_encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    data = frame_encoded.tobytes()
+
+    count = -(-len(data) // VIDEO_CHUNK_SIZE)
+    for index in range(count):
+        chunk = data[index * VIDEO_CHUNK_SIZE:(index + 1) * VIDEO_CHUNK_SIZE]
+        sock.sendto(VIDEO_CHUNK_HEADER.pack(frame_id & 0xFFFFFFFF, index, count) + chunk, addr)
+
+    return len(data)
+
+
+class VideoReceiver:
+    """Reassemble chunked video frames from a UDP socket.
+
+    Only one frame is assembled at a time. A chunk of a newer frame drops the
+    incomplete one, and chunks of older frames are ignored. Loss, reordering
+    or a path switch therefore costs at most the frames involved and never
+    desynchronizes the stream.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.frame_id = None
+        self.chunks = None  # Chunks of the frame being assembled, None once it is complete
+
+    def read_frame(self):
+        """Block until a whole frame has arrived and return it decoded."""
+        while True:
+            packet, _ = self.sock.recvfrom(BUFFER_SIZE)
+            if len(packet) <= VIDEO_CHUNK_HEADER.size:
+                continue
+            frame_id, index, count = VIDEO_CHUNK_HEADER.unpack_from(packet)
+            if index >= count:
+                continue
+
+            if frame_id != self.frame_id:
+                behind = (self.frame_id - frame_id) & 0xFFFFFFFF if self.frame_id is not None else 0
+                if 0 < behind <= VIDEO_RESYNC_GAP:
+                    continue  # Late chunk of a frame we already finished or gave up on
+                self.frame_id = frame_id
+                self.chunks = {}
+            elif self.chunks is None:
+                continue  # Duplicate chunk of a frame we already returned
+
+            self.chunks[index] = packet[VIDEO_CHUNK_HEADER.size:]
+            if len(self.chunks) == count:
+                data = b"".join(self.chunks[i] for i in range(count))
+                self.chunks = None
+                return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def pack_audio(sequence_number, data):
+    """Prefix an audio chunk with its sequence number."""
+    return AUDIO_SEQ_HEADER.pack(sequence_number) + data
+
+
+class AudioReceiver:
+    """Order incoming audio packets by sequence number and skip stale ones."""
+
+    def __init__(self, log_loss=True):
+        self.queue = queue.PriorityQueue()  # Priority queue for audio packet handling
+        self.latest_sequence = -1
+        self.lost = 0
+        self.log_loss = log_loss
+
+    def push(self, packet):
+        """Queue a packet and return the audio data that should be played now, if any."""
+        sequence_number = AUDIO_SEQ_HEADER.unpack_from(packet)[0]  # Extract sequence number
+        audio_data = packet[AUDIO_SEQ_HEADER.size:]  # Extract actual audio data
+
+        self.queue.put((sequence_number, audio_data))  # Add to queue for processing
+
+        if self.queue.qsize() > 0:  # Play the audio as it comes in
+            sequence_number, data = self.queue.get()
+            if sequence_number == self.latest_sequence + 1 or self.latest_sequence == -1:
+                self.latest_sequence = sequence_number
+                return sequence_number, data
+            elif sequence_number > self.latest_sequence + 1:
+                if self.log_loss:
+                    print(f"Packet loss detected! Expected {self.latest_sequence + 1}, got {sequence_number}")
+                self.lost += sequence_number - self.latest_sequence - 1
+                self.latest_sequence = sequence_number
+
+        return None
+
+
+class AudioEncoder:
+    """Encode 16-bit mono PCM in the negotiated audio codec."""
+
+    def __init__(self, audio):
+        self.codec = audio["codec"]
+        self.frame_size = audio["frame_size"]
+        if self.codec == "opus":
+            import opuslib  # Optional dependency, only needed when Opus was negotiated
+            self.encoder = opuslib.Encoder(audio["rate"], 1, "voip")
+            self.encoder.bitrate = audio["bitrate"]
+
+    def encode(self, data):
+        if self.codec == "opus":
+            return self.encoder.encode(data, self.frame_size)
+        return data
+
+
+class AudioDecoder:
+    """Decode audio in the negotiated codec back to 16-bit mono PCM."""
+
+    def __init__(self, audio):
+        self.codec = audio["codec"]
+        self.frame_size = audio["frame_size"]
+        if self.codec == "opus":
+            import opuslib
+            self.decoder = opuslib.Decoder(audio["rate"], 1)
+
+    def decode(self, data):
+        if self.codec == "opus":
+            return self.decoder.decode(data, self.frame_size)
+        return data
+
+
+def send_audio_stream(pa, sample_format, session, peer_ip, is_running, skip=None):
+    """Capture, encode and send microphone audio in the session's negotiated format.
+
+    Runs until is_running() returns False, reopening the microphone whenever
+    the session is renegotiated. peer_ip is called for every packet. skip, if
+    given, is called with each captured chunk and returning True drops it
+    (e.g. silence); dropped chunks use no sequence number, so the receiver
+    does not count them as lost.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stream = None
+    config = None
+    sequence_number = 0
+
+    while is_running():
+        try:
+            if config is not session.config:
+                if stream is not None:
+                    stream.close()
+                    stream = None
+                audio = session.config["audio"]
+                stream = pa.open(format=sample_format, channels=1, rate=audio["rate"],
+                                 frames_per_buffer=audio["frame_size"], input=True)
+                encoder = AudioEncoder(audio)
+                config = session.config
+
+            data = stream.read(audio["frame_size"], exception_on_overflow=False)
+            if skip is not None and skip(data):
+                continue
+            sock.sendto(pack_audio(sequence_number, encoder.encode(data)), (peer_ip(), audio["peer_port"]))
+            sequence_number += 1
+        except Exception as e:
+            print(f"[ERROR] Audio send error: {e}")
+            break
+
+    if stream is not None:
+        stream.close()
+    sock.close()
+
+
+def receive_audio_stream(pa, sample_format, session, bind_ip, is_running, process=None):
+    """Receive, decode and play audio in the session's negotiated format.
+
+    Runs until is_running() returns False. Codec, rate and port may all change
+    when the session is renegotiated, the socket and output stream follow.
+    process, if given, is called as process(samples, rate) on each decoded
+    int16 chunk and returns the samples to play (e.g. noise reduction).
+    """
+    sock = None
+    stream = None
+    config = None
+
+    while is_running():
+        try:
+            if config is not session.config:
+                audio = session.config["audio"]
+                if sock is None or sock.getsockname()[1] != audio["port"]:
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.bind((bind_ip, audio["port"]))
+                    sock.settimeout(0.5)
+                if stream is not None:
+                    stream.close()
+                    stream = None
+                stream = pa.open(format=sample_format, channels=1, rate=audio["rate"],
+                                 frames_per_buffer=audio["frame_size"], output=True)
+                decoder = AudioDecoder(audio)
+                receiver = AudioReceiver()
+                config = session.config
+
+            packet, _ = sock.recvfrom(MAX_AUDIO_PACKET)
+            playable = receiver.push(packet)
+            if playable is None:
+                continue
+            data = decoder.decode(playable[1])
+            if process is not None:
+                samples = process(np.frombuffer(data, dtype=np.int16), audio["rate"])
+                data = samples.astype(np.int16).tobytes()
+            stream.write(data)
+        except socket.timeout:
+            continue
+        except Exception as e:
+            print(f"[ERROR] Audio receive error: {e}")
+            if config is not session.config:
+                time.sleep(0.5)  # Setup failed, e.g. port in use, retry instead of spinning
+
+    if stream is not None:
+        stream.close()
+    if sock is not None:
+        sock.close()
@@ -0,0 +1,297 @@
+import json
+import os
+import secrets
+import threading
+import time
+from media import VIDEO_QUALITY
+
+# Configuration
+CONTROL_PREFIX = b"\x00ctl:"  # Marks control messages on the text channel, chat never starts with NUL
+ADVERTISE_INTERVAL = 1.0  # Seconds between resends until the peer confirms our capabilities
+MAX_ADVERTISE = 10  # Give up after this many unanswered resends, the peer probably does not negotiate
+CPU_UNITS_PER_CORE = 6  # CPU budget per core, in the units of audio_cpu() / video_cpu()
+CPU_WEIGHT = 50  # How many kbps one unit of CPU is worth when comparing costs
+JPEG_BYTES_PER_PIXEL = 0.1  # Rough JPEG size at quality 50, for bandwidth estimates
+
+# Lowest quality we are happy with; the cheapest configuration at or above it wins
+QUALITY_TARGET = {"sample_rate": 24000, "height": 480, "fps": 15}
+
+# (sample rate, frame size) combinations each audio codec can run in
+AUDIO_MODES = {
+    "pcm": [[44100, 1024], [16000, 320]],
+    "opus": [[48000, 960], [24000, 480], [16000, 320]],  # 20 ms frames
+}
+CODEC_CPU = {"pcm": 0.5, "opus": 1.0}
+OPUS_BITRATES = {48000: 64000, 24000: 32000, 16000: 24000}
+
+VIDEO_RESOLUTIONS = [[1280, 720], [640, 480], [480, 360], [320, 240]]
+VIDEO_FPS = [30, 15]
+
+
+def audio_bitrate(codec, rate):
+    """Return the bitrate of an audio mode in bits per second."""
+    if codec == "opus":
+        return OPUS_BITRATES[rate]
+    return rate * 16  # 16-bit mono PCM
+
+
+def audio_cpu(codec, rate):
+    """Return the CPU cost of an audio mode, noise reduction on the receiver scales with the sample rate."""
+    return CODEC_CPU[codec] + rate / 16000
+
+
+def video_cpu(width, height, fps):
+    """Return the CPU cost of JPEG encoding and decoding a video mode."""
+    return width * height * fps / 1e6 * 2
+
+
+def minimum_cpu_budget():
+    """Return the smallest CPU budget that still fits the cheapest Opus mode and the smallest video mode."""
+    rate = min(rate for rate, _ in AUDIO_MODES["opus"])
+    width, height = min(VIDEO_RESOLUTIONS, key=lambda resolution: resolution[0] * resolution[1])
+    return audio_cpu("opus", rate) + video_cpu(width, height, min(VIDEO_FPS))
+
+
+def local_capabilities(audio_ports, video_port, max_resolution=(1280, 720), max_fps=30, cpu_budget=None):
+    """Describe what this peer can send and receive."""
+    audio = {"pcm": AUDIO_MODES["pcm"]}
+    try:
+        import opuslib  # noqa: F401  Optional, Opus is only offered when it is installed
+        audio["opus"] = AUDIO_MODES["opus"]
+    except Exception:
+        pass
+
+    if cpu_budget is None:
+        cpu_budget = min(os.cpu_count() or 1, 4) * CPU_UNITS_PER_CORE
+
+    return {
+        "audio": audio,
+        "video": ["jpeg"],
+        "max_resolution": list(max_resolution),
+        "max_fps": max_fps,
+        "cpu_budget": cpu_budget,
+        "quality_target": QUALITY_TARGET,
+        "ports": {"audio": {codec: audio_ports[codec] for codec in audio}, "video": video_port},
+    }
+
+
+def valid_capabilities(caps):
+    """Return True if caps received from the peer has the structure local_capabilities() produces."""
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    try:
+        audio = caps["audio"]
+        ports = caps["ports"]
+        return (isinstance(audio, dict) and audio
+                and all(codec in AUDIO_MODES and isinstance(modes, list)
+                        and all(isinstance(mode, list) and len(mode) == 2 and all(map(is_number, mode))
+                                for mode in modes)
+                        for codec, modes in audio.items())
+                and isinstance(caps["video"], list)
+                and isinstance(caps["max_resolution"], list) and len(caps["max_resolution"]) == 2
+                and all(map(is_number, caps["max_resolution"]))
+                and is_number(caps["max_fps"]) and is_number(caps["cpu_budget"])
+                and all(is_number(caps["quality_target"][key]) for key in QUALITY_TARGET)
+                and all(isinstance(ports["audio"][codec], int) for codec in audio)
+                and isinstance(ports["video"], int))
+    except (KeyError, TypeError):
+        return False
+
+
+def legacy_config(audio_ports, video_port):
+    """Return the format run.py used before negotiation, so peers that never answer still work."""
+    return {
+        "generation": 0,
+        "audio": {"codec": "pcm", "rate": 44100, "frame_size": 1024, "bitrate": audio_bitrate("pcm", 44100),
+                  "port": audio_ports["pcm"], "peer_port": audio_ports["pcm"]},
+        "video": {"codec": "jpeg", "width": None, "height": None, "fps": 30, "quality": VIDEO_QUALITY,
+                  "port": video_port, "peer_port": video_port},
+    }
+
+
+def negotiate(local, remote):
+    """Pick the cheapest configuration both peers support that meets the quality target.
+
+    Both peers run this on the same pair of capabilities and reach the same
+    answer, so no extra round trip is needed to agree. If nothing meeting the
+    target fits the smaller CPU budget, audio is kept at target and video gets
+    the largest resolution and frame rate the budget still allows.
+    """
+    budget = min(local["cpu_budget"], remote["cpu_budget"])
+    target = {key: max(local["quality_target"][key], remote["quality_target"][key]) for key in QUALITY_TARGET}
+
+    audio_options = sorted((codec, rate, frame_size)
+                           for codec, modes in local["audio"].items()
+                           for rate, frame_size in modes
+                           if [rate, frame_size] in remote["audio"].get(codec, []))
+    max_width = min(local["max_resolution"][0], remote["max_resolution"][0])
+    max_height = min(local["max_resolution"][1], remote["max_resolution"][1])
+    max_fps = min(local["max_fps"], remote["max_fps"])
+    video_options = sorted((width, height, fps)
+                           for width, height in VIDEO_RESOLUTIONS
+                           for fps in VIDEO_FPS
+                           if width <= max_width and height <= max_height and fps <= max_fps)
+    if not audio_options or not video_options or "jpeg" not in remote["video"]:
+        return None
+
+    candidates = []
+    for codec, rate, frame_size in audio_options:
+        for width, height, fps in video_options:
+            cpu = audio_cpu(codec, rate) + video_cpu(width, height, fps)
+            kbps = audio_bitrate(codec, rate) / 1000 + width * height * fps * JPEG_BYTES_PER_PIXEL * 8 / 1000
+            candidates.append({
+                "cost": kbps + cpu * CPU_WEIGHT,
+                "cpu": cpu,
+                "audio_ok": rate >= target["sample_rate"],
+                "video_ok": height >= target["height"] and fps >= target["fps"],
+                "audio": (codec, rate, frame_size),
+                "video": (width, height, fps),
+            })
+
+    affordable = [c for c in candidates if c["cpu"] <= budget]
+    meeting = [c for c in affordable if c["audio_ok"] and c["video_ok"]]
+    if meeting:
+        choice = min(meeting, key=lambda c: c["cost"])
+    elif affordable:
+        # Keep audio at target if at all possible and give the rest of the budget to video
+        choice = min(affordable, key=lambda c: (not c["audio_ok"],
+                                                -c["video"][0] * c["video"][1] * c["video"][2],
+                                                c["cost"]))
+    else:
+        choice = min(candidates, key=lambda c: c["cost"])
+
+    codec, rate, frame_size = choice["audio"]
+    width, height, fps = choice["video"]
+    return {
+        "audio": {"codec": codec, "rate": rate, "frame_size": frame_size, "bitrate": audio_bitrate(codec, rate),
+                  "port": local["ports"]["audio"][codec], "peer_port": remote["ports"]["audio"][codec]},
+        "video": {"codec": "jpeg", "width": width, "height": height, "fps": fps, "quality": VIDEO_QUALITY,
+                  "port": local["ports"]["video"], "peer_port": remote["ports"]["video"]},
+    }
+
+
+class Session:
+    """Exchange capabilities with the peer over the control channel and track the agreed configuration.
+
+    Each side resends its capabilities, tagged with a generation number, until
+    the peer echoes that generation back. A message also says whether its
+    sender is still waiting for that echo, so a lost reply is answered again.
+    Once both sides hold each other's latest capabilities they both run
+    negotiate() and switch to the result.
+    Calling update_capabilities() mid-call starts a renegotiation. Messages
+    also carry a random session id, so a peer that restarts mid-call is
+    noticed and negotiated with from scratch.
+    """
+
+    def __init__(self, send, audio_ports, video_port, **capabilities):
+        self.send = send  # Callable that delivers a control message to the peer
+        self.caps = local_capabilities(audio_ports, video_port, **capabilities)
+        self.session_id = secrets.token_hex(8)
+        self.generation = 1
+        self.peer_session = None
+        self.peer_caps = None
+        self.peer_generation = 0
+        self.acked = 0  # Our latest generation the peer has confirmed
+        self.agreed = None
+        self.config = legacy_config(audio_ports, video_port)
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._advertise, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def update_capabilities(self, **changes):
+        """Change local capabilities (e.g. a lower CPU budget) and renegotiate."""
+        with self.lock:
+            self.caps.update(changes)
+            self.generation += 1
+        print(f"Renegotiating session: {changes}")
+        self._send_caps()
+
+    def handle(self, data):
+        """Process a control message received on the text channel."""
+        try:
+            msg = json.loads(data[len(CONTROL_PREFIX):].decode())
+        except ValueError:
+            return
+        if not isinstance(msg, dict) or msg.get("type") != "caps":
+            return
+        session, generation, ack = msg.get("session"), msg.get("generation"), msg.get("ack")
+        if not (isinstance(session, str) and isinstance(generation, int) and isinstance(ack, int)
+                and valid_capabilities(msg.get("caps"))):
+            print("[WARN] Ignoring malformed control message.")
+            return
+
+        with self.lock:
+            if session != self.peer_session:
+                # The peer (re)started, forget what it had confirmed before
+                self.peer_session = session
+                self.peer_generation = 0
+                self.acked = 0
+                self.agreed = None
+            is_new = generation != self.peer_generation
+            self.peer_caps = msg["caps"]
+            self.peer_generation = generation
+            self.acked = max(self.acked, ack)
+            peer_behind = self.acked < self.generation
+
+        if is_new or peer_behind or msg.get("need_ack") is True:
+            self._send_caps()  # Confirm the peer's capabilities and make sure it has our latest
+        self._agree()
+
+    def _send_caps(self):
+        with self.lock:
+            msg = {"type": "caps", "session": self.session_id, "generation": self.generation,
+                   "ack": self.peer_generation, "need_ack": self.acked != self.generation,
+                   "caps": self.caps}
+        try:
+            self.send(CONTROL_PREFIX + json.dumps(msg).encode())
+        except OSError as e:
+            print(f"[ERROR] Control send error: {e}")
+
+    def _advertise(self):
+        """Resend our capabilities until the peer confirms them.
+
+        A peer that has never answered is given up on after MAX_ADVERTISE
+        resends; one that has answered before is retried for as long as it
+        takes, so a renegotiation is never left half done.
+        """
+        attempts = 0
+        generation = self.generation
+        while self.running:
+            if generation != self.generation:
+                generation = self.generation
+                attempts = 0
+            if self.acked != self.generation and (self.peer_session is not None or attempts < MAX_ADVERTISE):
+                self._send_caps()
+                attempts += 1
+            time.sleep(ADVERTISE_INTERVAL)
+
+    def _agree(self):
+        with self.lock:
+            if self.peer_caps is None or self.acked != self.generation:
+                return
+            key = (self.generation, self.peer_generation)
+            if key == self.agreed:
+                return
+            self.agreed = key
+            try:
+                config = negotiate(self.caps, self.peer_caps)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"[ERROR] Negotiation failed: {e}")
+                return
+            if config is None:
+                print("[ERROR] No common media configuration with peer, keeping the current one.")
+                return
+            config["generation"] = self.config["generation"] + 1
+            self.config = config  # Media threads pick this up on their next iteration
+
+        audio, video = config["audio"], config["video"]
+        print(f"Session agreed: {audio['codec']} {audio['rate']} Hz/{audio['frame_size']} samples, "
+              f"video {video['width']}x{video['height']}@{video['fps']}")
@@ -0,0 +1,142 @@
+import heapq
+import random
+import socket
+import threading
+import time
+
+# Configuration
+MAX_DATAGRAM = 65535
+MAX_QUEUE_DELAY = 0.5  # Seconds of backlog before a bandwidth-capped link tail-drops
+
+
+class ImpairmentProxy:
+    """Userspace UDP proxy that impairs traffic like netem: delay, jitter, loss, reordering, rate caps.
+
+    Datagrams sent to ``listen_addr`` are forwarded one-way to ``target_addr``.
+    Jitter keeps datagrams in order; only ``reorder`` lets later datagrams
+    overtake earlier ones. Burst loss uses a Gilbert-Elliott model:
+    ``burst_start`` is the chance of entering a loss burst, ``burst_end`` the
+    chance of leaving it again.
+    """
+
+    def __init__(self, listen_addr, target_addr, delay=0.0, jitter=0.0, loss=0.0,
+                 burst_start=0.0, burst_end=0.5, reorder=0.0, reorder_delay=0.02,
+                 bandwidth=None, seed=None):
+        self.target_addr = target_addr
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.burst_start = burst_start
+        self.burst_end = burst_end
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.bandwidth = bandwidth  # bits per second, None for unlimited
+        self.random = random.Random(seed)
+
+        self.sock_in = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_in.bind(listen_addr)
+        self.sock_in.settimeout(0.2)
+        self.listen_addr = self.sock_in.getsockname()
+        self.sock_out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.pending = []  # Heap of (release time, arrival order, datagram)
+        self.cond = threading.Condition()
+        self.in_burst = False
+        self.link_free_at = 0.0
+        self.last_release = 0.0
+        self.order = 0
+
+        self.stats = {"received": 0, "forwarded": 0, "lost": 0, "burst_lost": 0,
+                      "reordered": 0, "queue_dropped": 0}
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._forward, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify()
+        self.sock_in.close()
+        self.sock_out.close()
+
+    def _drop(self):
+        """Decide whether to drop the next datagram."""
+        if self.in_burst:
+            if self.random.random() < self.burst_end:
+                self.in_burst = False
+        elif self.random.random() < self.burst_start:
+            self.in_burst = True
+
+        if self.in_burst:
+            self.stats["burst_lost"] += 1
+            return True
+        if self.random.random() < self.loss:
+            self.stats["lost"] += 1
+            return True
+        return False
+
+    def _release_time(self, now, size):
+        """Return when a datagram arriving now should leave the proxy, or None to tail-drop it."""
+        if self.bandwidth:
+            # Serialize datagrams onto the capped link one after another
+            start = max(now, self.link_free_at)
+            if start - now > MAX_QUEUE_DELAY:
+                self.stats["queue_dropped"] += 1
+                return None
+            self.link_free_at = start + size * 8 / self.bandwidth
+            now = self.link_free_at
+
+        release = now + self.delay
+        if self.jitter:
+            release += self.random.uniform(-self.jitter, self.jitter)
+        release = max(release, now, self.last_release)
+        if self.reorder and self.random.random() < self.reorder:
+            self.stats["reordered"] += 1
+            return release + self.reorder_delay  # Hold back so later datagrams overtake it
+        self.last_release = release
+        return release
+
+    def _receive(self):
+        while self.running:
+            try:
+                packet, _ = self.sock_in.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            self.stats["received"] += 1
+            if self._drop():
+                continue
+
+            release = self._release_time(time.perf_counter(), len(packet))
+            if release is None:
+                continue
+
+            with self.cond:
+                heapq.heappush(self.pending, (release, self.order, packet))
+                self.order += 1
+                self.cond.notify()
+
+    def _forward(self):
+        while self.running:
+            with self.cond:
+                if not self.pending:
+                    self.cond.wait(0.2)
+                    continue
+                release, _, packet = self.pending[0]
+                wait = release - time.perf_counter()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.pending)
+
+            try:
+                self.sock_out.sendto(packet, self.target_addr)
+                self.stats["forwarded"] += 1
+            except OSError:
+                break
@@ -0,0 +1,230 @@
+import ipaddress
+import json
+import math
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+
+# Configuration
+PORT_PROBE = 12349  # UDP port for candidate exchange and path probes
+PROBE_INTERVAL = 1.0  # Seconds between probe rounds, kept up for the whole call
+PROBE_TIMEOUT = 2.0  # A probe without a reply after this long counts as lost
+PROBE_WINDOW = 10  # Number of recent probes the loss rate is computed over
+LOSS_PENALTY = 0.5  # Seconds of RTT a fully lossy path is worth when scoring
+SWITCH_MARGIN = 0.8  # Another path must score 20% better before we switch to it
+MAX_CANDIDATES = 16  # Most peer addresses we will ever probe
+
+
+def local_addresses():
+    """Return the usable IPv4 addresses of this host, default-route interface first."""
+    addrs = []
+
+    # Ask the kernel which address it would use for the default route (nothing is sent)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("192.0.2.1", 9))
+            addrs.append(s.getsockname()[0])
+    except OSError:
+        pass
+
+    try:
+        import psutil  # Optional, sees every NIC including VPNs
+        for nic_addrs in psutil.net_if_addrs().values():
+            addrs += [a.address for a in nic_addrs if a.family == socket.AF_INET]
+    except ImportError:
+        try:
+            addrs += socket.gethostbyname_ex(socket.gethostname())[2]
+        except OSError:
+            pass
+
+    usable = []
+    for addr in addrs:
+        ip = ipaddress.ip_address(addr)
+        if ip.is_loopback or ip.is_link_local or addr in usable:
+            continue  # Skips the 127.0.1.1 that gethostbyname often returns
+        usable.append(addr)
+    return usable or ["127.0.0.1"]
+
+
+class PathStats:
+    """RTT and loss history for one remote address."""
+
+    def __init__(self):
+        self.rtt = None  # Smoothed RTT in seconds
+        self.results = deque(maxlen=PROBE_WINDOW)  # True for answered probes, False for lost ones
+
+    def record(self, rtt):
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        self.results.append(True)
+
+    def record_loss(self):
+        self.results.append(False)
+
+    def loss(self):
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def score(self):
+        """Lower is better; paths that never answered score infinity."""
+        if self.rtt is None or not any(self.results):
+            return math.inf
+        return self.rtt + self.loss() * LOSS_PENALTY
+
+
+class PathSelector:
+    """Exchange candidate addresses with the peer, probe each of them and track the best one.
+
+    Media senders call peer_ip() for every packet, so a switch takes effect on
+    the next packet. Media sockets are not bound to a local interface, so only
+    the peer address is chosen here and the kernel routes to it as usual; which
+    of our interfaces gets used follows from that. Receivers should listen on
+    all interfaces so that traffic arriving over any path is accepted.
+
+    Every probe carries a random per-session token. The peer's token is only
+    learned from probes coming from the address typed into the dialog, and
+    probes without it are ignored, so other hosts cannot inject candidates
+    or answer pings to pull the call over to themselves.
+    """
+
+    def __init__(self, peer_ip, port=PORT_PROBE):
+        try:
+            peer_ip = socket.gethostbyname(peer_ip)  # The dialog also accepts host names
+        except OSError as e:
+            print(f"[ERROR] Cannot resolve {peer_ip}: {e}")
+        self.port = port
+        self.local = local_addresses()
+        self.typed_ip = peer_ip
+        self.remote = [peer_ip]  # The address typed into the dialog is the first candidate
+        self.token = secrets.token_hex(8)
+        self.peer_token = None
+        self.current = peer_ip
+        self.paths = {}
+        self.pending = {}  # Probe id -> (remote, send time)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.running = False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", port))
+        self.sock.settimeout(0.5)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._probe, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+    def peer_ip(self):
+        """Return the peer address of the best path."""
+        return self.current
+
+    def is_peer(self, ip):
+        """Return True if ip is one of the peer's addresses."""
+        return ip in self.remote
+
+    def add_remote(self, addrs):
+        """Add candidate peer addresses learned from the peer, ignoring anything that is not an IPv4 address."""
+        with self.lock:
+            for addr in addrs:
+                if len(self.remote) >= MAX_CANDIDATES:
+                    break
+                try:
+                    ip = ipaddress.IPv4Address(addr)
+                except (ValueError, TypeError):
+                    continue
+                if not (ip.is_multicast or ip.is_unspecified) and addr not in self.remote:
+                    self.remote.append(addr)
+
+    def _send(self, msg, addr):
+        try:
+            self.sock.sendto(json.dumps(msg).encode(), addr)
+        except OSError:
+            pass  # Unreachable right now, the probe will just count as lost
+
+    def _probe(self):
+        """Ping every peer address, expire unanswered pings and pick the best path."""
+        while self.running:
+            now = time.monotonic()
+            with self.lock:
+                for probe_id, (remote, sent) in list(self.pending.items()):
+                    if now - sent > PROBE_TIMEOUT:
+                        del self.pending[probe_id]
+                        self.paths[remote].record_loss()
+
+                probes = []
+                for remote in self.remote:
+                    self.paths.setdefault(remote, PathStats())
+                    self.pending[self.next_id] = (remote, now)
+                    probes.append((self.next_id, remote))
+                    self.next_id += 1
+
+            for probe_id, remote in probes:
+                # Every ping carries our candidates, so the exchange needs no extra round trip
+                self._send({"type": "ping", "id": probe_id, "token": self.token,
+                            "candidates": self.local}, (remote, self.port))
+
+            self._select()
+            time.sleep(PROBE_INTERVAL)
+
+    def _receive(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+                msg = json.loads(data.decode())
+            except socket.timeout:
+                continue
+            except (OSError, ValueError):
+                if not self.running:
+                    break
+                continue
+
+            if not isinstance(msg, dict):
+                continue
+            token = msg.get("token")
+
+            if msg.get("type") == "ping":
+                if addr[0] == self.typed_ip and isinstance(token, str):
+                    self.peer_token = token  # Also picks up a new token if the peer restarts
+                if token is None or token != self.peer_token:
+                    continue
+                # The source address is a candidate too, even if the peer could not see it locally
+                candidates = msg.get("candidates")
+                if not isinstance(candidates, list):
+                    candidates = []
+                self.add_remote([addr[0]] + candidates[:MAX_CANDIDATES])
+                self._send({"type": "pong", "id": msg.get("id"), "token": self.token}, addr)
+            elif msg.get("type") == "pong" and isinstance(msg.get("id"), int):
+                with self.lock:
+                    if msg.get("id") not in self.pending:
+                        continue
+                    if self.peer_token is None and addr[0] == self.typed_ip and isinstance(token, str):
+                        self.peer_token = token
+                    # A multihomed peer may answer from another of its addresses, the token is what counts
+                    if token is None or token != self.peer_token:
+                        continue
+                    remote, sent = self.pending.pop(msg.get("id"))
+                    self.paths[remote].record(time.monotonic() - sent)
+
+    def _select(self):
+        """Switch to the lowest scoring path if it is clearly better than the current one."""
+        with self.lock:
+            if not self.paths:
+                return
+            best = min(self.paths, key=lambda remote: self.paths[remote].score())
+            best_score = self.paths[best].score()
+            current_stats = self.paths.get(self.current)
+            current_score = current_stats.score() if current_stats else math.inf
+
+            if best_score == math.inf or best == self.current:
+                return
+            if best_score < current_score * SWITCH_MARGIN or current_score == math.inf:
+                stats = self.paths[best]
+                print(f"Switching path to {best} (rtt {stats.rtt * 1000:.1f} ms, loss {stats.loss():.0%})")
+                self.current = best
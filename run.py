@@ -1,32 +1,28 @@
 import socket
 import threading
 import pyaudio
-import struct
-import queue
 import time
-import numpy as np
 import noisereduce as nr
 import tkinter as tk
 from tkinter import simpledialog, scrolledtext
 from PIL import Image, ImageTk
 import cv2
-import pickle
+from media import (BUFFER_SIZE, send_video_frame, VideoReceiver, send_audio_stream,
+                   receive_audio_stream)
+from negotiation import CONTROL_PREFIX, Session, minimum_cpu_budget
+from path_discovery import PathSelector
+from screen_share import SCREEN_FPS, SCREEN_RCVBUF, TileSender, ScreenCanvas, open_screen_source
 
 # Configuration
 PORT_TEXT = 12345
 PORT_VIDEO = 12346
 PORT_AUDIO = 5000  # Port for audio, updated to match the provided example
-BUFFER_SIZE = 4096 * 10
-CHUNK = 1024
+PORT_AUDIO_OPUS = 12350  # Port for sequenced Opus audio
+PORT_SCREEN = 12348  # Port for screen-share tiles
 FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 44100
-
-# Create a queue for audio data
-audio_queue = queue.PriorityQueue()  # Priority queue for audio packet handling
-
-# Sequence number tracking for audio
-latest_sequence = -1
+OVERLOAD_SECONDS = 2.0  # How long video may fall behind its frame rate before we renegotiate
+RECOVERY_SECONDS = 30.0  # How long video must keep up comfortably before we ask for more again
+MIN_CPU_BUDGET = minimum_cpu_budget()  # Never ask for less than Opus plus the smallest video mode needs
 
 class P2PChat:
     def __init__(self, root):
@@ -44,6 +40,9 @@ class P2PChat:
         self.send_button = tk.Button(root, text="Send", command=self.send_message)
         self.send_button.pack(padx=10, pady=5, fill=tk.X)
 
+        self.share_button = tk.Button(root, text="Share Screen", command=self.toggle_screen_share)
+        self.share_button.pack(padx=10, pady=5, fill=tk.X)
+
         self.exit_button = tk.Button(root, text="Exit", command=self.exit_chat, bg="red", fg="white")
         self.exit_button.pack(padx=10, pady=5, fill=tk.X)
 
@@ -57,8 +56,13 @@ class P2PChat:
         self.peer_video_canvas = tk.Canvas(self.video_frame, bg="black")
         self.peer_video_canvas.grid(row=0, column=1, padx=5, pady=5, sticky="nsew")
 
+        # Peer Screen Share Canvas
+        self.peer_screen_canvas = tk.Canvas(self.video_frame, bg="black")
+        self.peer_screen_canvas.grid(row=1, column=0, columnspan=2, padx=5, pady=5, sticky="nsew")
+
         # Make the video columns resizable
         self.video_frame.grid_rowconfigure(0, weight=1)
+        self.video_frame.grid_rowconfigure(1, weight=1)
         self.video_frame.grid_columnconfigure(0, weight=1)
         self.video_frame.grid_columnconfigure(1, weight=1)
 
@@ -66,16 +70,25 @@ class P2PChat:
         self.audio = pyaudio.PyAudio()
 
         # Networking setup for text, video, and audio
-        self.my_ip = socket.gethostbyname(socket.gethostname())
+        self.my_ip = "0.0.0.0"  # Listen on every interface, PathSelector picks which one to use
         self.sock_text = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock_text.bind((self.my_ip, PORT_TEXT))
 
         self.sock_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_screen = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
         # User input for peer IP
         self.target_ip = simpledialog.askstring("Target IP", "Enter Peer IP:")
+
+        # Discover all of the peer's addresses and keep sending over the fastest one
+        self.paths = PathSelector(self.target_ip).start()
+
+        # Agree on codecs, rates, resolution and ports with the peer over the text channel
+        self.session = Session(self.send_control, {"pcm": PORT_AUDIO, "opus": PORT_AUDIO_OPUS}, PORT_VIDEO).start()
+        self.max_cpu_budget = self.session.caps["cpu_budget"]
         
         self.running = True
+        self.sharing_screen = False
 
         # Start threads for message, video, and audio
         threading.Thread(target=self.receive_messages, daemon=True).start()
@@ -83,68 +96,17 @@ class P2PChat:
         threading.Thread(target=self.receive_video, daemon=True).start()
         threading.Thread(target=self.send_audio, daemon=True).start()
         threading.Thread(target=self.receive_audio, daemon=True).start()
+        threading.Thread(target=self.receive_screen, daemon=True).start()
 
     def send_audio(self):
-        """Capture and send audio data with sequence numbers."""
-        stream = self.audio.open(format=FORMAT,
-                                channels=CHANNELS,
-                                rate=RATE,
-                                frames_per_buffer=CHUNK,
-                                input=True)
-        
-        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        sequence_number = 0  
+        """Capture and send audio data with sequence numbers in the negotiated format."""
         print("Streaming audio...")
-        
-        while self.running:
-            try:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                packet = struct.pack("!I", sequence_number) + data  # Pack sequence number and audio data
-                server.sendto(packet, (self.target_ip, PORT_AUDIO))  # Send packet to the peer
-                sequence_number += 1
-                time.sleep(CHUNK / RATE)  # Ensure proper sending rate
-            except Exception as e:
-                print(f"[ERROR] Audio send error: {e}")
-                break
+        send_audio_stream(self.audio, FORMAT, self.session, self.paths.peer_ip, lambda: self.running)
 
     def receive_audio(self):
         """Receive audio, apply noise reduction, and play it back."""
-        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        receiver.bind((self.my_ip, PORT_AUDIO))
-
-        stream = self.audio.open(format=FORMAT,
-                                 channels=CHANNELS,
-                                 rate=RATE,
-                                 output=True,
-                                 frames_per_buffer=CHUNK)
-
-        global latest_sequence
-
-        while self.running:
-            try:
-                packet, _ = receiver.recvfrom(CHUNK + 4)  # 4 bytes for sequence number
-                sequence_number = struct.unpack("!I", packet[:4])[0]  # Extract sequence number
-                audio_data = packet[4:]  # Extract actual audio data
-
-                audio_queue.put((sequence_number, audio_data))  # Add to queue for processing
-
-                if audio_queue.qsize() > 0:  # Play the audio as it comes in
-                    sequence_number, data = audio_queue.get()
-                    if sequence_number == latest_sequence + 1 or latest_sequence == -1:
-                        # Apply noise reduction on audio data
-                        audio_array = np.frombuffer(data, dtype=np.int16)
-                        reduced_audio = nr.reduce_noise(y=audio_array, sr=RATE)
-                        cleaned_data = reduced_audio.astype(np.int16).tobytes()
-                        stream.write(cleaned_data)  # Play the cleaned audio
-                        latest_sequence = sequence_number
-                    elif sequence_number > latest_sequence + 1:
-                        print(f"Packet loss detected! Expected {latest_sequence + 1}, got {sequence_number}")
-                        latest_sequence = sequence_number
-
-            except Exception as e:
-                print(f"[ERROR] Audio receive error: {e}")
-                break
+        receive_audio_stream(self.audio, FORMAT, self.session, self.my_ip, lambda: self.running,
+                             process=lambda samples, rate: nr.reduce_noise(y=samples, sr=rate))
 
     def send_video(self):
         """Send video frames and display local video."""
@@ -155,6 +117,11 @@ class P2PChat:
 
         cap = cv2.VideoCapture(camera_index)
 
+        frame_id = 0
+        last_sent = 0.0
+        overloaded_since = None
+        keeping_up_since = None
+
         while self.running:
             ret, frame = cap.read()
             if not ret:
@@ -164,53 +131,120 @@ class P2PChat:
             # Show my video (IN THIS FUNCTION)
             self.show_local_video(frame)
 
-            # Encode and send
-            _, frame_encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 50])
-            data = pickle.dumps(frame_encoded)
-
-            # Send frame size first
-            self.sock_video.sendto(struct.pack("Q", len(data)), (self.target_ip, PORT_VIDEO))
+            # Send at the negotiated frame rate and resolution
+            video = self.session.config["video"]
+            start = time.monotonic()
+            if start - last_sent < 1 / video["fps"]:
+                continue
+            last_sent = start
+            if video["width"]:
+                # Scale down to fit the negotiated box, keeping the camera's aspect ratio
+                height, width = frame.shape[:2]
+                scale = min(video["width"] / width, video["height"] / height)
+                if scale < 1:
+                    frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
 
-            # Send frame in chunks
-            for i in range(0, len(data), BUFFER_SIZE):
-                self.sock_video.sendto(data[i:i + BUFFER_SIZE], (self.target_ip, PORT_VIDEO))
+            # Encode and send
+            send_video_frame(self.sock_video, frame, (self.paths.peer_ip(), video["peer_port"]), frame_id, video["quality"])
+            frame_id += 1
+
+            # Ask for a cheaper configuration if encoding cannot keep up with the frame rate,
+            # and for a better one again once it has kept up comfortably for a while
+            elapsed = time.monotonic() - start
+            if elapsed > 1 / video["fps"]:
+                keeping_up_since = None
+                overloaded_since = overloaded_since or start
+                if start - overloaded_since > OVERLOAD_SECONDS:
+                    self.adjust_cpu_budget(0.75)
+                    overloaded_since = None
+            else:
+                overloaded_since = None
+                if elapsed < 0.5 / video["fps"]:
+                    keeping_up_since = keeping_up_since or start
+                    if start - keeping_up_since > RECOVERY_SECONDS:
+                        self.adjust_cpu_budget(1 / 0.75)
+                        keeping_up_since = None
+                else:
+                    keeping_up_since = None
 
         cap.release()
 
+    def adjust_cpu_budget(self, factor):
+        """Scale the advertised CPU budget, within limits, and renegotiate if it changed."""
+        current = self.session.caps["cpu_budget"]
+        budget = min(max(current * factor, MIN_CPU_BUDGET), self.max_cpu_budget)
+        if budget != current:
+            self.session.update_capabilities(cpu_budget=budget)
+
     def receive_video(self):
         """Receive and display peer's video."""
         sock_video_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock_video_recv.bind((self.my_ip, PORT_VIDEO))
 
-        data = b""
-        payload_size = struct.calcsize("Q")
+        video_receiver = VideoReceiver(sock_video_recv)
 
         while self.running:
             try:
-                while len(data) < payload_size:
-                    packet, _ = sock_video_recv.recvfrom(BUFFER_SIZE)
-                    data += packet
+                frame = video_receiver.read_frame()
+                self.show_peer_video(frame)
+
+            except Exception as e:
+                print(f"[ERROR] Video receive error: {e}")
+
+        sock_video_recv.close()
+
+    def toggle_screen_share(self):
+        """Start or stop sharing the screen."""
+        if self.sharing_screen:
+            self.sharing_screen = False
+            self.share_button.config(text="Share Screen")
+        else:
+            self.sharing_screen = True
+            self.share_button.config(text="Stop Sharing")
+            threading.Thread(target=self.send_screen, daemon=True).start()
+
+    def send_screen(self):
+        """Send only the changed tiles of the screen."""
+        source = open_screen_source()
+        sender = TileSender(self.sock_screen)
+
+        while self.running and self.sharing_screen:
+            start = time.monotonic()
+            try:
+                frame = source.grab()
+                sender.send(frame, (self.paths.peer_ip(), PORT_SCREEN))
+            except Exception as e:
+                print(f"[ERROR] Screen send error: {e}")
+                break
+            time.sleep(max(0.0, 1 / SCREEN_FPS - (time.monotonic() - start)))
 
-                packed_msg_size = data[:payload_size]
-                data = data[payload_size:]
-                msg_size = struct.unpack("Q", packed_msg_size)[0]
+        source.close()
 
-                while len(data) < msg_size:
-                    packet, _ = sock_video_recv.recvfrom(BUFFER_SIZE)
-                    data += packet
+    def receive_screen(self):
+        """Receive screen tiles and composite them onto the peer's screen canvas."""
+        sock_screen_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock_screen_recv.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SCREEN_RCVBUF)
+        sock_screen_recv.bind((self.my_ip, PORT_SCREEN))
 
-                frame_data = data[:msg_size]
-                data = data[msg_size:]
+        canvas = ScreenCanvas()
+        last_shown = 0.0
 
-                frame_encoded = pickle.loads(frame_data)
-                frame = cv2.imdecode(frame_encoded, cv2.IMREAD_COLOR)
+        while self.running:
+            try:
+                packet, _ = sock_screen_recv.recvfrom(65535)
+                if not canvas.apply(packet):
+                    continue
 
-                self.show_peer_video(frame)
+                # Redraw at most SCREEN_FPS times a second, not once per tile
+                now = time.monotonic()
+                if now - last_shown >= 1 / SCREEN_FPS:
+                    self.show_peer_screen(canvas.image)
+                    last_shown = now
 
             except Exception as e:
-                print(f"[ERROR] Video receive error: {e}")
+                print(f"[ERROR] Screen receive error: {e}")
 
-        sock_video_recv.close()
+        sock_screen_recv.close()
 
     def show_local_video(self, frame):
         """Show local webcam feed on the Tkinter canvas."""
@@ -260,6 +294,25 @@ class P2PChat:
         self.peer_video_canvas.create_image(0, 0, image=img_tk, anchor=tk.NW)
         self.peer_video_canvas.image = img_tk  # Keep a reference to avoid garbage collection
 
+    def show_peer_screen(self, frame):
+        """Show the peer's shared screen on the Tkinter canvas."""
+        canvas_width = self.peer_screen_canvas.winfo_width()
+        canvas_height = self.peer_screen_canvas.winfo_height()
+
+        height, width = frame.shape[:2]
+        scale = min(canvas_width / width, canvas_height / height)
+        new_width = max(1, int(width * scale))
+        new_height = max(1, int(height * scale))
+
+        resized_frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+        frame_rgb = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2RGB)
+        img = Image.fromarray(frame_rgb)
+        img_tk = ImageTk.PhotoImage(image=img)
+
+        self.peer_screen_canvas.create_image(0, 0, image=img_tk, anchor=tk.NW)
+        self.peer_screen_canvas.image = img_tk  # Keep a reference to avoid garbage collection
+
     def get_available_camera(self):
         """Find the first available camera index."""
         for i in range(5):  # Check indexes 0 to 4
@@ -274,18 +327,26 @@ class P2PChat:
         """Send message to peer"""
         msg = self.entry.get()
         if msg:
-            self.sock_text.sendto(msg.encode(), (self.target_ip, PORT_TEXT))
+            self.sock_text.sendto(msg.encode(), (self.paths.peer_ip(), PORT_TEXT))
             self.chat_area.config(state=tk.NORMAL)
             self.chat_area.insert(tk.END, f"[You]: {msg}\n")
             self.chat_area.yview(tk.END)
             self.chat_area.config(state=tk.DISABLED)
             self.entry.delete(0, tk.END)
 
+    def send_control(self, data):
+        """Send a session control message to the peer over the text channel."""
+        self.sock_text.sendto(data, (self.paths.peer_ip(), PORT_TEXT))
+
     def receive_messages(self):
         """Receive messages and display in chat"""
         while self.running:
             try:
                 data, addr = self.sock_text.recvfrom(BUFFER_SIZE)
+                if data.startswith(CONTROL_PREFIX):
+                    if self.paths.is_peer(addr[0]):  # Only the peer may renegotiate our session
+                        self.session.handle(data)
+                    continue
                 msg = f"[{addr[0]}]: {data.decode()}\n"
                 self.chat_area.config(state=tk.NORMAL)
                 self.chat_area.insert(tk.END, msg)
@@ -299,6 +360,9 @@ class P2PChat:
         self.running = False
         self.sock_text.close()
         self.sock_video.close()
+        self.sock_screen.close()
+        self.paths.stop()
+        self.session.stop()
         # self.sock_audio.close()  # Close audio socket
         self.audio.terminate()   # Clean up PyAudio resources
         self.root.quit()
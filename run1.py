@@ -2,96 +2,82 @@ import socket
 import threading
 import pyaudio
 import numpy as np
-import queue
-import opuslib  # Low-latency Opus codec for compression
+from media import send_audio_stream, receive_audio_stream
+from negotiation import CONTROL_PREFIX, Session
 
 # Configuration
-PORT_AUDIO = 12347  # UDP port for audio
-BUFFER_SIZE = 1024  # Smaller buffer for low latency
-AUDIO_QUEUE_SIZE = 5  # Reduce queue size for lower latency
+PORT_TEXT = 12345  # UDP port for session control, shared with the chat of run.py and run2.py
+PORT_VIDEO = 12346  # Only advertised so negotiation works, this script has no video
+PORT_AUDIO = 5000  # UDP port for PCM audio, the same as run.py
+PORT_AUDIO_OPUS = 12350  # UDP port for Opus audio, the same as run.py
+BUFFER_SIZE = 4096 * 10
 SILENCE_THRESHOLD = 1000  # RMS threshold to detect silence
 
-# Opus settings
-FRAME_SIZE = 960  # Opus works best with 20ms (960 samples at 48kHz)
-OPUS_BITRATE = 64000  # 64 kbps for good quality
-
-# Create a queue for audio data
-audio_queue = queue.Queue(maxsize=AUDIO_QUEUE_SIZE)
-
 class AudioHandler:
     def __init__(self, target_ip):
-        self.target_ip = target_ip
-        self.my_ip = socket.gethostbyname(socket.gethostname())
+        self.target_ip = socket.gethostbyname(target_ip)  # Resolved so control messages can be matched against it
+        self.my_ip = "0.0.0.0"  # Listen on every interface, not just the one the hostname resolves to
 
         self.running = True
 
-        # Initialize UDP sockets
-        self.sock_audio = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock_audio_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock_audio_recv.bind((self.my_ip, PORT_AUDIO))
+        # Initialize UDP socket for session control
+        self.sock_text = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_text.bind((self.my_ip, PORT_TEXT))
 
         # PyAudio settings
         self.pyaudio_instance = pyaudio.PyAudio()
-        self.stream = self.pyaudio_instance.open(
-            format=pyaudio.paInt16,
-            channels=1,
-            rate=48000,  # Higher quality
-            frames_per_buffer=FRAME_SIZE,
-            input=True,
-            output=True
-        )
 
-        # Opus encoder & decoder
-        self.encoder = opuslib.Encoder(48000, 1, 'voip')
-        self.encoder.bitrate = OPUS_BITRATE
-        self.decoder = opuslib.Decoder(48000, 1)
+        # Agree on codec and rate with the peer; Opus is picked when both sides have opuslib.
+        # The smallest video mode is advertised so a run.py peer sends us as little video as possible.
+        self.session = Session(self.send_control, {"pcm": PORT_AUDIO, "opus": PORT_AUDIO_OPUS}, PORT_VIDEO,
+                               max_resolution=(320, 240), max_fps=15).start()
 
         # Start threads
+        threading.Thread(target=self.receive_messages, daemon=True).start()
         threading.Thread(target=self.capture_audio, daemon=True).start()
         threading.Thread(target=self.receive_audio, daemon=True).start()
-        threading.Thread(target=self.play_audio_from_queue, daemon=True).start()
 
-    def capture_audio(self):
-        """Capture and send audio with silence detection and Opus encoding."""
-        while self.running:
-            audio_data = self.stream.read(FRAME_SIZE, exception_on_overflow=False)
-            samples = np.frombuffer(audio_data, dtype=np.int16)
-            rms = np.sqrt(np.mean(samples**2))
+    def is_silent(self, audio_data):
+        """Return True for chunks too quiet to be worth sending."""
+        samples = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32)
+        rms = np.sqrt(np.mean(samples**2))
+        if rms > SILENCE_THRESHOLD:
+            return False
+        print("🔇 Silence detected, not sending audio.")
+        return True
 
-            if rms > SILENCE_THRESHOLD:
-                compressed_audio = self.encoder.encode(audio_data, FRAME_SIZE)
-                self.sock_audio.sendto(compressed_audio, (self.target_ip, PORT_AUDIO))
-            else:
-                print("🔇 Silence detected, not sending audio.")
+    def capture_audio(self):
+        """Capture and send audio with silence detection in the negotiated format."""
+        send_audio_stream(self.pyaudio_instance, pyaudio.paInt16, self.session,
+                          lambda: self.target_ip, lambda: self.running, skip=self.is_silent)
 
     def receive_audio(self):
-        """Receive and queue audio data."""
-        while self.running:
-            try:
-                packet, _ = self.sock_audio_recv.recvfrom(400)  # Opus compressed packets are small
-                if not audio_queue.full():
-                    audio_queue.put(packet)
-            except Exception as e:
-                print(f"[ERROR] Audio receive error: {e}")
+        """Receive and play audio in the negotiated format."""
+        receive_audio_stream(self.pyaudio_instance, pyaudio.paInt16, self.session, self.my_ip,
+                             lambda: self.running)
 
-    def play_audio_from_queue(self):
-        """Dequeue and play audio data smoothly."""
+    def send_control(self, data):
+        """Send a session control message to the peer."""
+        self.sock_text.sendto(data, (self.target_ip, PORT_TEXT))
+
+    def receive_messages(self):
+        """Handle session control messages and print chat messages from the peer."""
         while self.running:
-            if not audio_queue.empty():
-                packet = audio_queue.get_nowait()
-                decompressed_audio = self.decoder.decode(packet, FRAME_SIZE)
-                self.stream.write(decompressed_audio)
-                audio_queue.task_done()
-            else:
-                threading.Event().wait(0.01)  # Reduce CPU usage
+            try:
+                data, addr = self.sock_text.recvfrom(BUFFER_SIZE)
+                if data.startswith(CONTROL_PREFIX):
+                    if addr[0] == self.target_ip:  # Only the peer may renegotiate our session
+                        self.session.handle(data)
+                    continue
+                print(f"[{addr[0]}]: {data.decode(errors='replace')}")
+            except OSError:
+                break
 
     def stop(self):
         """Stop all audio processes."""
         self.running = False
-        self.sock_audio.close()
-        self.sock_audio_recv.close()
-        self.stream.stop_stream()
-        self.stream.close()
+        self.session.stop()
+        self.sock_text.close()
         self.pyaudio_instance.terminate()
 
 # Example usage
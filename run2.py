@@ -2,16 +2,17 @@ import socket
 import threading
 import pyaudio
 import cv2
-import pickle
-import struct
 import tkinter as tk
 from tkinter import simpledialog, scrolledtext
 from PIL import Image, ImageTk
+from media import send_video_frame, VideoReceiver, send_audio_stream, receive_audio_stream
+from negotiation import CONTROL_PREFIX, Session
 
 # Configuration
 PORT_TEXT = 12345
 PORT_VIDEO = 12346
-PORT_AUDIO = 12347  # Port for audio
+PORT_AUDIO = 5000  # Port for PCM audio, the same as run.py so the two can talk
+PORT_AUDIO_OPUS = 12350  # Port for Opus audio, used when both peers have opuslib
 BUFFER_SIZE = 4096 * 10
 
 class P2PChat:
@@ -48,26 +49,25 @@ class P2PChat:
         self.video_frame.grid_columnconfigure(0, weight=1)
         self.video_frame.grid_columnconfigure(1, weight=1)
 
-        # Audio configurations
-        self.chunk_size = 1024 * 30
+        # Audio configurations, rate and chunk size come from the negotiated session
         self.sample_format = pyaudio.paInt16
-        self.channels = 1
-        self.rate = 44100
 
         # Initialize PyAudio for audio capture
         self.audio = pyaudio.PyAudio()
 
         # Networking setup for text, video, and audio
-        self.my_ip = socket.gethostbyname(socket.gethostname())
+        self.my_ip = "0.0.0.0"  # Listen on every interface, not just the one the hostname resolves to
         self.sock_text = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock_text.bind((self.my_ip, PORT_TEXT))
 
         self.sock_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock_audio = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        # User input for peer IP
-        self.target_ip = simpledialog.askstring("Target IP", "Enter Peer IP:")
-        
+        # User input for peer IP, resolved so control messages can be matched against it
+        self.target_ip = socket.gethostbyname(simpledialog.askstring("Target IP", "Enter Peer IP:"))
+
+        # Agree on audio codec and rate with the peer over the text channel, like run.py
+        self.session = Session(self.send_control, {"pcm": PORT_AUDIO, "opus": PORT_AUDIO_OPUS}, PORT_VIDEO).start()
+
         self.running = True
 
         # Start threads for message, video, and audio
@@ -78,72 +78,13 @@ class P2PChat:
         threading.Thread(target=self.receive_audio, daemon=True).start()
 
     def send_audio(self):
-        """Capture and send audio data."""
-        stream = self.audio.open(format=self.sample_format,
-                                channels=self.channels,
-                                rate=self.rate,
-                                frames_per_buffer=self.chunk_size,
-                                input=True)
-        
-        while self.running:
-            try:
-                # Read audio data from the microphone
-                audio_data = stream.read(self.chunk_size)
-                
-                print(f"Sending {len(audio_data)} bytes of audio data")  # Log data sent
-                
-                # Send the audio data over UDP
-                self.sock_audio.sendto(audio_data, (self.target_ip, PORT_AUDIO))
-            except Exception as e:
-                print(f"[ERROR] Audio send error: {e}")
-                break
-
+        """Capture and send audio data in the negotiated format."""
+        send_audio_stream(self.audio, self.sample_format, self.session,
+                          lambda: self.target_ip, lambda: self.running)
 
     def receive_audio(self):
         """Receive and play audio data from the peer."""
-        sock_audio_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock_audio_recv.bind(("0.0.0.0", PORT_AUDIO))  # Bind to all interfaces
-
-        while self.running:
-            try:
-                packet, _ = sock_audio_recv.recvfrom(self.chunk_size)
-                if not packet:
-                    continue
-
-                print(f"🔊 Received {len(packet)} bytes of audio data.")  # Debugging
-
-                self.play_audio(packet)  # Play as soon as received
-            except Exception as e:
-                print(f"[ERROR] Audio receive error: {e}")
-                break
-
-
-
-
-    def play_audio(self, audio_data):
-        """Play received audio data."""
-        if not hasattr(self, 'audio_stream') or self.audio_stream is None:
-            try:
-                self.audio_stream = self.audio.open(format=self.sample_format,
-                                                    channels=self.channels,
-                                                    rate=self.rate,
-                                                    frames_per_buffer=self.chunk_size,
-                                                    output=True)
-                print("✅ Audio Stream Initialized.")
-            except Exception as e:
-                print(f"[ERROR] Failed to initialize audio stream: {e}")
-                return
-
-        try:
-            print(f"🎵 Playing {len(audio_data)} bytes of audio data.")  # Debugging
-            self.audio_stream.write(audio_data)
-        except Exception as e:
-            print(f"[ERROR] Failed to play audio: {e}")
-
-
-            
-
-
+        receive_audio_stream(self.audio, self.sample_format, self.session, self.my_ip, lambda: self.running)
 
     def send_video(self):
         """Send video frames and display local video."""
@@ -153,6 +94,7 @@ class P2PChat:
             return
 
         cap = cv2.VideoCapture(camera_index)
+        frame_id = 0
 
         while self.running:
             ret, frame = cap.read()
@@ -164,15 +106,8 @@ class P2PChat:
             self.show_local_video(frame)
 
             # Encode and send
-            _, frame_encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 50])
-            data = pickle.dumps(frame_encoded)
-
-            # Send frame size first
-            self.sock_video.sendto(struct.pack("Q", len(data)), (self.target_ip, PORT_VIDEO))
-
-            # Send frame in chunks
-            for i in range(0, len(data), BUFFER_SIZE):
-                self.sock_video.sendto(data[i:i + BUFFER_SIZE], (self.target_ip, PORT_VIDEO))
+            send_video_frame(self.sock_video, frame, (self.target_ip, PORT_VIDEO), frame_id)
+            frame_id += 1
 
         cap.release()
 
@@ -181,29 +116,11 @@ class P2PChat:
         sock_video_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock_video_recv.bind((self.my_ip, PORT_VIDEO))
 
-        data = b""
-        payload_size = struct.calcsize("Q")
+        video_receiver = VideoReceiver(sock_video_recv)
 
         while self.running:
             try:
-                while len(data) < payload_size:
-                    packet, _ = sock_video_recv.recvfrom(BUFFER_SIZE)
-                    data += packet
-
-                packed_msg_size = data[:payload_size]
-                data = data[payload_size:]
-                msg_size = struct.unpack("Q", packed_msg_size)[0]
-
-                while len(data) < msg_size:
-                    packet, _ = sock_video_recv.recvfrom(BUFFER_SIZE)
-                    data += packet
-
-                frame_data = data[:msg_size]
-                data = data[msg_size:]
-
-                frame_encoded = pickle.loads(frame_data)
-                frame = cv2.imdecode(frame_encoded, cv2.IMREAD_COLOR)
-
+                frame = video_receiver.read_frame()
                 self.show_peer_video(frame)
 
             except Exception as e:
@@ -280,11 +197,19 @@ class P2PChat:
             self.chat_area.config(state=tk.DISABLED)
             self.entry.delete(0, tk.END)
 
+    def send_control(self, data):
+        """Send a session control message to the peer over the text channel."""
+        self.sock_text.sendto(data, (self.target_ip, PORT_TEXT))
+
     def receive_messages(self):
         """Receive messages and display in chat"""
         while self.running:
             try:
                 data, addr = self.sock_text.recvfrom(BUFFER_SIZE)
+                if data.startswith(CONTROL_PREFIX):
+                    if addr[0] == self.target_ip:  # Only the peer may renegotiate our session
+                        self.session.handle(data)
+                    continue
                 msg = f"[{addr[0]}]: {data.decode()}\n"
                 self.chat_area.config(state=tk.NORMAL)
                 self.chat_area.insert(tk.END, msg)
@@ -298,7 +223,7 @@ class P2PChat:
         self.running = False
         self.sock_text.close()
         self.sock_video.close()
-        self.sock_audio.close()  # Close audio socket
+        self.session.stop()
         self.audio.terminate()   # Clean up PyAudio resources
         self.root.quit()
 
@@ -0,0 +1,181 @@
+import struct
+import time
+import numpy as np
+import cv2
+
+# Configuration
+TILE_SIZE = 64  # Screen is split into TILE_SIZE x TILE_SIZE blocks
+TILE_QUALITY = 70  # JPEG quality for tiles (text needs more than the webcam's 50)
+FULL_REFRESH_INTERVAL = 30.0  # Seconds over which every tile is resent once, a background trickle that repairs lost tiles
+SCREEN_FPS = 10  # Screen content changes slowly, no need for camera frame rate
+MAX_TILES_PER_FRAME = 48  # Cap on tiles per tick so bursts fit the receiver's socket buffer
+SCREEN_RCVBUF = 4 * 1024 * 1024  # Receive buffer for the screen socket
+
+# Tile packet header: frame id, screen width, screen height, tile x, tile y, tile width, tile height
+TILE_HEADER = struct.Struct("!IHHHHHH")
+
+
+def dirty_mask(prev, frame, tile_size=TILE_SIZE):
+    """Return a (rows, cols) boolean grid of the tiles that differ between two frames."""
+    height, width = frame.shape[:2]
+    # Keep the colour channels as extra columns instead of reducing them first, one pass less over the frame
+    changed = (prev != frame).reshape(height, -1)
+    channels = changed.shape[1] // width
+
+    # Pad up to a whole number of tiles so the block reshape works on any resolution
+    pad_h = -height % tile_size
+    pad_w = -width % tile_size * channels
+    if pad_h or pad_w:
+        changed = np.pad(changed, ((0, pad_h), (0, pad_w)))
+
+    rows = changed.shape[0] // tile_size
+    cols = changed.shape[1] // (tile_size * channels)
+    return changed.reshape(rows, tile_size, cols, tile_size * channels).any(axis=(1, 3))
+
+
+def dirty_tiles(prev, frame, tile_size=TILE_SIZE):
+    """Return (row, col) of every tile that differs between two frames."""
+    return np.argwhere(dirty_mask(prev, frame, tile_size))
+
+
+class ScreenSource:
+    """Capture the screen with mss (X11, Windows and macOS)."""
+
+    def __init__(self, monitor=1):
+        import mss  # Optional dependency, only needed when actually sharing a screen
+        self.sct = mss.mss()
+        self.monitor = self.sct.monitors[monitor]
+
+    def grab(self):
+        """Grab one BGR frame of the monitor."""
+        shot = self.sct.grab(self.monitor)
+        return np.asarray(shot)[:, :, :3]  # Drop alpha from BGRA
+
+    def close(self):
+        self.sct.close()
+
+
+class SyntheticScreen:
+    """Fake framebuffer for testing without a display: a static document with a blinking cursor."""
+
+    def __init__(self, width=1280, height=720):
+        self.frame = np.full((height, width, 3), 255, dtype=np.uint8)
+        for y in range(40, height - 40, 24):  # Grey bars standing in for lines of text
+            self.frame[y:y + 10, 40:width - 40 - (y * 7) % 300] = 80
+        self.cursor = (60, 120)
+        self.start = time.monotonic()
+
+    def grab(self):
+        """Return the current framebuffer, toggling the cursor twice a second."""
+        x, y = self.cursor
+        visible = int((time.monotonic() - self.start) * 2) % 2 == 0
+        self.frame[y:y + 16, x:x + 2] = 0 if visible else 255
+        return self.frame.copy()
+
+    def close(self):
+        pass
+
+
+def open_screen_source():
+    """Open the real screen if possible, otherwise fall back to a synthetic one."""
+    try:
+        return ScreenSource()
+    except Exception as e:
+        print(f"[WARN] Screen capture unavailable ({e}), using synthetic screen.")
+        return SyntheticScreen()
+
+
+class TileSender:
+    """Encode and send only the tiles that changed since the previous frame.
+
+    Tiles that are due but not yet sent are kept in an "owed" grid. Each tick
+    sends at most max_tiles of them, continuing where the last tick stopped, so
+    the first frame and large changes are spread over several ticks instead of
+    overflowing the receiver. The loss-recovery refresh works the same way:
+    every tick marks the next slice of tiles as owed, so the whole screen is
+    resent once per refresh_interval without a burst.
+    """
+
+    def __init__(self, sock, tile_size=TILE_SIZE, quality=TILE_QUALITY,
+                 refresh_interval=FULL_REFRESH_INTERVAL, fps=SCREEN_FPS, max_tiles=MAX_TILES_PER_FRAME):
+        self.sock = sock
+        self.tile_size = tile_size
+        self.quality = quality
+        self.refresh_interval = refresh_interval
+        self.fps = fps
+        self.max_tiles = max_tiles
+        self.prev = None
+        self.owed = None
+        self.send_cursor = 0
+        self.refresh_cursor = 0
+        self.frame_id = 0
+
+    def send(self, frame, addr):
+        """Send the owed tiles of a frame and return how many were sent."""
+        height, width = frame.shape[:2]
+        if self.prev is None or self.prev.shape != frame.shape:
+            rows = -(-height // self.tile_size)
+            cols = -(-width // self.tile_size)
+            self.owed = np.ones((rows, cols), dtype=bool)  # Receiver needs the whole screen first
+        else:
+            self.owed |= dirty_mask(self.prev, frame, self.tile_size)
+
+        # Rotate the loss-recovery refresh through the grid a slice per tick
+        owed = self.owed.reshape(-1)
+        per_tick = -(-owed.size // max(1, int(self.refresh_interval * self.fps)))
+        refresh = (self.refresh_cursor + np.arange(per_tick)) % owed.size
+        owed[refresh] = True
+        self.refresh_cursor = int(refresh[-1] + 1) % owed.size
+
+        # Send up to max_tiles owed tiles, starting after the last one sent
+        indices = np.flatnonzero(owed)
+        indices = np.concatenate((indices[indices >= self.send_cursor], indices[indices < self.send_cursor]))
+        indices = indices[:self.max_tiles]
+        if len(indices):
+            owed[indices] = False
+            self.send_cursor = int(indices[-1] + 1) % owed.size
+
+        cols = self.owed.shape[1]
+        for index in indices:
+            row, col = divmod(int(index), cols)
+            x = col * self.tile_size
+            y = row * self.tile_size
+            tile = frame[y:y + self.tile_size, x:x + self.tile_size]
+            _, tile_encoded = cv2.imencode(".jpg", tile, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            header = TILE_HEADER.pack(self.frame_id, width, height, x, y,
+                                      tile.shape[1], tile.shape[0])
+            self.sock.sendto(header + tile_encoded.tobytes(), addr)
+
+        self.prev = frame
+        self.frame_id = (self.frame_id + 1) & 0xFFFFFFFF
+        return len(indices)
+
+
+class ScreenCanvas:
+    """Persistent receiver-side canvas that tiles are composited onto."""
+
+    def __init__(self):
+        self.image = None
+        self.frame_id = 0
+
+    def apply(self, packet):
+        """Composite one tile packet onto the canvas. Returns False if the packet was unusable."""
+        if len(packet) <= TILE_HEADER.size:
+            return False
+
+        frame_id, width, height, x, y, tile_w, tile_h = TILE_HEADER.unpack_from(packet)
+        tile = cv2.imdecode(np.frombuffer(packet, dtype=np.uint8, offset=TILE_HEADER.size),
+                            cv2.IMREAD_COLOR)
+        if tile is None or tile.shape[:2] != (tile_h, tile_w):
+            return False
+
+        # (Re)allocate on first packet or when the sender's resolution changes
+        if self.image is None or self.image.shape[:2] != (height, width):
+            self.image = np.zeros((height, width, 3), dtype=np.uint8)
+
+        if x + tile_w > width or y + tile_h > height:
+            return False
+
+        self.image[y:y + tile_h, x:x + tile_w] = tile
+        self.frame_id = frame_id
+        return True